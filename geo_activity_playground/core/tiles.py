@@ -1,7 +1,9 @@
 import functools
 import logging
 import math
+import os
 import pathlib
+import threading
 import time
 
 import numpy as np
@@ -39,8 +41,20 @@ def download_file(url: str, destination: pathlib.Path):
         headers={"User-Agent": "Martin's Geo Activity Playground"},
     )
     assert r.ok
-    with open(destination, "wb") as f:
-        f.write(r.content)
+    # write next to the destination and move it into place, so that an
+    # interrupted or concurrent download never leaves a truncated tile behind
+    # in the cache; the name is unique per thread and the file is created with
+    # plain open to get the usual umask permissions
+    partial = destination.with_name(
+        f"{destination.name}.{os.getpid()}-{threading.get_ident()}.part"
+    )
+    try:
+        with open(partial, "wb") as f:
+            f.write(r.content)
+        partial.replace(destination)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
     time.sleep(0.1)
 
 
@@ -57,6 +71,19 @@ def get_tile(zoom: int, x: int, y: int) -> Image.Image:
     return image
 
 
+@functools.lru_cache()
+def get_grayscale_tile(zoom: int, x: int, y: int) -> np.ndarray:
+    """
+    Returns the luminance of the OSM tile in [0, 1] as float32 array.
+
+    The array is shared through the cache and therefore read-only.
+    """
+    tile = np.asarray(get_tile(zoom, x, y), dtype=np.float32) / np.float32(255)
+    gray = tile[:, :, :3] @ np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+    gray.setflags(write=False)
+    return gray
+
+
 def latlon_to_xy(lat_deg: float, lon_deg: float, zoom: int) -> tuple[float, float]:
     """
     Based on https://github.com/remisalmon/Strava-local-heatmap.
@@ -17,17 +17,20 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import concurrent.futures
 import logging
+import math
 import pathlib
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import scipy.ndimage
 import sklearn.cluster
 
 from .core.sources import TimeSeriesSource
 from .core.tiles import compute_tile
-from .core.tiles import get_tile
+from .core.tiles import get_grayscale_tile
 from .core.tiles import latlon_to_xy
 from geo_activity_playground.core.activities import ActivityRepository
 
@@ -37,39 +40,61 @@ logger = logging.getLogger(__name__)
 # globals
 PLT_COLORMAP = "hot"  # matplotlib color map
 MAX_TILE_COUNT = 2000  # maximum number of tiles to download
+MAX_DOWNLOAD_THREADS = 2  # concurrent tile downloads, see OSM tile usage policy
 MAX_HEATMAP_SIZE = (2160, 3840)  # maximum heatmap size in pixel
 
 OSM_TILE_SIZE = 256  # OSM tile size in pixel
 OSM_MAX_ZOOM = 19  # OSM maximum zoom level
 
 
-def gaussian_filter(image, sigma):
-    # returns image filtered with a gaussian function of variance sigma**2
+def gaussian_kernel(sigma: float, radius: int) -> np.ndarray:
+    # returns the normalized 1D gaussian kernel of variance sigma**2 with
+    # 2 * radius + 1 taps, to be applied along each axis in turn
     #
-    # input: image = numpy.ndarray
-    #        sigma = float
-    # output: image = numpy.ndarray
+    # input: sigma = float
+    #        radius = int
+    # output: kernel = numpy.ndarray
 
-    i, j = np.meshgrid(
-        np.arange(image.shape[0]), np.arange(image.shape[1]), indexing="ij"
-    )
-
-    mu = (int(image.shape[0] / 2.0), int(image.shape[1] / 2.0))
-
-    gaussian = (
-        1.0
-        / (2.0 * np.pi * sigma * sigma)
-        * np.exp(-0.5 * (((i - mu[0]) / sigma) ** 2 + ((j - mu[1]) / sigma) ** 2))
-    )
-
-    gaussian = np.roll(gaussian, (-mu[0], -mu[1]), axis=(0, 1))
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    return (kernel / kernel.sum()).astype(np.float32)
 
-    image_fft = np.fft.rfft2(image)
-    gaussian_fft = np.fft.rfft2(gaussian)
 
-    image = np.fft.irfft2(image_fft * gaussian_fft)
-
-    return image
+def add_trackpoints(data: np.ndarray, xy_data: np.ndarray, sigma_pixel: int) -> None:
+    # adds 1 to the (2 * sigma_pixel)**2 pixels around each trackpoint
+    #
+    # the points are binned once into a hit map padded by sigma_pixel, then
+    # every stamp is summed from its integral image, which costs the same for
+    # any stamp size and needs no per-point index arrays
+    #
+    # input: data = numpy.ndarray, modified in place
+    #        xy_data = numpy.ndarray of (x, y) pixel coordinates
+    #        sigma_pixel = int
+
+    height, width = data.shape
+    size = 2 * sigma_pixel
+    padded_height = height + size
+    padded_width = width + size
+
+    rows = xy_data[:, 1].astype(np.intp) + sigma_pixel
+    cols = xy_data[:, 0].astype(np.intp) + sigma_pixel
+    inside = (0 <= rows) & (rows < padded_height) & (0 <= cols) & (cols < padded_width)
+    hits = np.bincount(
+        rows[inside] * padded_width + cols[inside],
+        minlength=padded_height * padded_width,
+    ).reshape(padded_height, padded_width)
+
+    # integral[r, c] is the number of hits above and left of (r, c)
+    integral = np.zeros((padded_height + 1, padded_width + 1), dtype=hits.dtype)
+    np.cumsum(np.cumsum(hits, axis=0), axis=1, out=integral[1:, 1:])
+
+    # pixel (r, c) receives the stamps of the padded hits in rows and
+    # columns r + 1 to r + size and c + 1 to c + size
+    top = integral[1 : height + 1]
+    bottom = integral[size + 1 :]
+    stamps = bottom[:, size + 1 :] - bottom[:, 1 : width + 1]
+    stamps -= top[:, size + 1 :]
+    stamps += top[:, 1 : width + 1]
+    data += stamps
 
 
 def add_margin(lower: int, upper: int) -> tuple[int, int]:
@@ -92,7 +117,20 @@ def render_heatmap(
         x_tile_max, y_tile_min = map(int, latlon_to_xy(lat_max, lon_max, zoom))
 
     else:
+        # the span in tiles doubles with every zoom level, so start at the
+        # largest zoom that can possibly fit and then only step down to account
+        # for the rounding to whole tiles
+        x_min, y_max = latlon_to_xy(lat_min, lon_min, 0)
+        x_max, y_min = latlon_to_xy(lat_max, lon_max, 0)
+
         zoom = OSM_MAX_ZOOM
+        for span, max_size in [
+            (x_max - x_min, MAX_HEATMAP_SIZE[0]),
+            (y_max - y_min, MAX_HEATMAP_SIZE[1]),
+        ]:
+            if span > 0:
+                zoom = min(zoom, math.floor(math.log2(max_size / OSM_TILE_SIZE / span)))
+        zoom = max(zoom, 0)
 
         while True:
             x_tile_min, y_tile_max = map(int, latlon_to_xy(lat_min, lon_min, zoom))
@@ -110,50 +148,47 @@ def render_heatmap(
     if tile_count > MAX_TILE_COUNT:
         exit("ERROR zoom value too high, too many tiles to download")
 
+    num_tiles_y = y_tile_max - y_tile_min + 1
+    num_tiles_x = x_tile_max - x_tile_min + 1
+
+    # tiles are filled through a (tile row, pixel row, tile column, pixel
+    # column) view, which shares its memory with the 2D supertile
     supertile = np.zeros(
-        (
-            (y_tile_max - y_tile_min + 1) * OSM_TILE_SIZE,
-            (x_tile_max - x_tile_min + 1) * OSM_TILE_SIZE,
-            3,
-        )
+        (num_tiles_y * OSM_TILE_SIZE, num_tiles_x * OSM_TILE_SIZE), dtype=np.float32
     )
-
-    n = 0
-    for x in range(x_tile_min, x_tile_max + 1):
-        for y in range(y_tile_min, y_tile_max + 1):
-            n += 1
-
-            tile = np.array(get_tile(zoom, x, y)) / 255
-
-            i = y - y_tile_min
-            j = x - x_tile_min
-
-            supertile[
-                i * OSM_TILE_SIZE : (i + 1) * OSM_TILE_SIZE,
-                j * OSM_TILE_SIZE : (j + 1) * OSM_TILE_SIZE,
-                :,
-            ] = tile[:, :, :3]
-
-    supertile = np.sum(supertile * [0.2126, 0.7152, 0.0722], axis=2)  # to grayscale
-    supertile = 1.0 - supertile  # invert colors
-    supertile = np.dstack((supertile, supertile, supertile))  # to rgb
+    grid = supertile.reshape(num_tiles_y, OSM_TILE_SIZE, num_tiles_x, OSM_TILE_SIZE)
+
+    # fetch tiles concurrently, downloads are dominated by network latency
+    coordinates = [
+        (x, y)
+        for x in range(x_tile_min, x_tile_max + 1)
+        for y in range(y_tile_min, y_tile_max + 1)
+    ]
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_DOWNLOAD_THREADS
+    ) as executor:
+        tiles = executor.map(lambda xy: get_grayscale_tile(zoom, *xy), coordinates)
+        for (x, y), tile in zip(coordinates, tiles):
+            grid[y - y_tile_min, :, x - x_tile_min, :] = tile
+
+    background = np.subtract(1.0, supertile, out=supertile)  # invert colors
 
     # fill trackpoints
     sigma_pixel = 1
 
-    data = np.zeros(supertile.shape[:2])
+    data = np.zeros(background.shape, dtype=np.float32)
 
-    xy_data = latlon_to_xy(lat_lon_data[:, 0], lat_lon_data[:, 1], zoom)
-
-    xy_data = np.array(xy_data).T
-    xy_data = np.round(
-        (xy_data - [x_tile_min, y_tile_min]) * OSM_TILE_SIZE
-    )  # to supertile coordinates
+    # to supertile coordinates, transformed in place on a single buffer; the
+    # projection stays float64 because tile indices at high zoom exceed the
+    # precision of float32
+    xy_data = np.column_stack(
+        latlon_to_xy(lat_lon_data[:, 0], lat_lon_data[:, 1], zoom)
+    )
+    xy_data -= [x_tile_min, y_tile_min]
+    xy_data *= OSM_TILE_SIZE
+    xy_data = np.round(xy_data, out=xy_data).astype(np.int32)
 
-    for j, i in xy_data.astype(int):
-        data[
-            i - sigma_pixel : i + sigma_pixel, j - sigma_pixel : j + sigma_pixel
-        ] += 1.0
+    add_trackpoints(data, xy_data, sigma_pixel)
 
     res_pixel = (
         156543.03 * np.cos(np.radians(np.mean(lat_lon_data[:, 0]))) / (2.0**zoom)
@@ -163,20 +198,22 @@ def render_heatmap(
     # (Strava records trackpoints every 5 meters in average for cycling activites)
     m = np.round((1.0 / 5.0) * res_pixel * num_activities)
 
-    data[data > m] = m
+    np.minimum(data, m, out=data)
 
-    # equalize histogram and compute kernel density estimation
-    data_hist, _ = np.histogram(data, bins=int(m + 1))
+    # equalize histogram and compute kernel density estimation, the clipped
+    # data holds integer counts in [0, m] so they can be binned directly
+    data_int = data.astype(np.int32)
+    data_hist = np.bincount(data_int.ravel(), minlength=int(m) + 1)
 
     data_hist = np.cumsum(data_hist) / data.size  # normalized cumulated histogram
 
-    for i in range(data.shape[0]):
-        for j in range(data.shape[1]):
-            data[i, j] = m * data_hist[int(data[i, j])]  # histogram equalization
+    lut = (m * data_hist).astype(np.float32)  # histogram equalization lookup table
+    data = lut[data_int]
 
-    data = gaussian_filter(
-        data, float(sigma_pixel)
-    )  # kernel density estimation with normal kernel
+    # kernel density estimation with normal kernel, truncated at 2 sigma
+    kernel = gaussian_kernel(sigma_pixel, 2 * sigma_pixel)
+    data = scipy.ndimage.convolve1d(data, kernel, axis=0)
+    data = scipy.ndimage.convolve1d(data, kernel, axis=1)
 
     data = (data - data.min()) / (data.max() - data.min())  # normalize to [0,1]
 
@@ -184,15 +221,14 @@ def render_heatmap(
     cmap = plt.get_cmap(PLT_COLORMAP)
 
     data_color = cmap(data)
-    data_color[data_color == cmap(0.0)] = 0.0  # remove background color
 
-    for c in range(3):
-        supertile[:, :, c] = (1.0 - data_color[:, :, c]) * supertile[
-            :, :, c
-        ] + data_color[:, :, c]
+    # blend all channels at once against the shared grayscale background
+    color = data_color[:, :, :3].astype(np.float32)
+    color *= (data >= 1.0 / cmap.N)[:, :, None]  # remove background color
+    supertile = (1.0 - color) * background[:, :, None] + color
 
-    min_x, max_x = add_margin(int(min(xy_data[:, 1])), int(max(xy_data[:, 1])))
-    min_y, max_y = add_margin(int(min(xy_data[:, 0])), int(max(xy_data[:, 0])))
+    min_x, max_x = add_margin(int(xy_data[:, 1].min()), int(xy_data[:, 1].max()))
+    min_y, max_y = add_margin(int(xy_data[:, 0].min()), int(xy_data[:, 0].max()))
     supertile = supertile[min_x:max_x, min_y:max_y, :]
     return supertile
 
@@ -204,7 +240,7 @@ def generate_heatmaps_per_cluster(repository: ActivityRepository) -> None:
     for activity in repository.iter_activities():
         df = repository.get_time_series(activity.id)
         if "latitude" in df.columns:
-            latlon = np.column_stack([df["latitude"], df["longitude"]])
+            latlon = df[["latitude", "longitude"]].to_numpy()
             names.extend([activity.id] * len(df))
             arrays.append(latlon)
     latlon = np.row_stack(arrays)
@@ -246,6 +282,6 @@ def generate_heatmaps_per_cluster(repository: ActivityRepository) -> None:
         logger.info(
             f"Rendering heatmap for cluster {cluster_id} with {len(group)} elements …"
         )
-        latlon = np.column_stack([group.lat, group.lon])
+        latlon = group[["lat", "lon"]].to_numpy()
         heatmap = render_heatmap(latlon, num_activities=len(group.activity.unique()))
         plt.imsave(output_dir / f"Cluster-{i}.png", heatmap)
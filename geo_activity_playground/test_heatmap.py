@@ -0,0 +1,49 @@
+import numpy as np
+
+from .heatmap import add_trackpoints
+
+
+def stamp_per_point(
+    shape: tuple[int, int], xy_data: np.ndarray, sigma_pixel: int
+) -> np.ndarray:
+    data = np.zeros(shape)
+    for j, i in xy_data.astype(int):
+        data[
+            max(0, i - sigma_pixel) : max(0, i + sigma_pixel),
+            max(0, j - sigma_pixel) : max(0, j + sigma_pixel),
+        ] += 1.0
+    return data
+
+
+def test_add_trackpoints_interior() -> None:
+    xy_data = np.array([[5, 5], [5, 5], [3, 7], [9, 1]])
+    data = np.zeros((12, 10))
+    add_trackpoints(data, xy_data, 1)
+    assert np.array_equal(data, stamp_per_point(data.shape, xy_data, 1))
+
+
+def test_add_trackpoints_edges() -> None:
+    xy_data = np.array([[0, 5], [5, 0], [0, 0], [9, 11], [10, 12], [3, 12]])
+    for sigma_pixel in [1, 2, 3]:
+        data = np.zeros((12, 10))
+        add_trackpoints(data, xy_data, sigma_pixel)
+        assert np.array_equal(
+            data, stamp_per_point(data.shape, xy_data, sigma_pixel)
+        ), sigma_pixel
+
+
+def test_add_trackpoints_out_of_range() -> None:
+    xy_data = np.array([[-1, 5], [5, -2], [-10, -10], [50, 5], [5, 50], [11, 13]])
+    for sigma_pixel in [1, 2]:
+        data = np.zeros((12, 10))
+        add_trackpoints(data, xy_data, sigma_pixel)
+        assert np.array_equal(
+            data, stamp_per_point(data.shape, xy_data, sigma_pixel)
+        ), sigma_pixel
+
+
+def test_add_trackpoints_edge_stamp_is_kept() -> None:
+    data = np.zeros((12, 10))
+    add_trackpoints(data, np.array([[5, 0]]), 1)
+    assert data.sum() == 2
+    assert data[0, 4] == data[0, 5] == 1
@@ -10,10 +10,10 @@ import pandas as pd
 
 from geo_activity_playground.core.activities import ActivityRepository
 from geo_activity_playground.core.heatmap import get_all_points
-from geo_activity_playground.core.tiles import get_tile
+from geo_activity_playground.core.tiles import get_grayscale_tile
 from geo_activity_playground.core.tiles import get_tile_upper_left_lat_lon
 from geo_activity_playground.core.tiles import latlon_to_xy
-from geo_activity_playground.heatmap import gaussian_filter
+from geo_activity_playground.heatmap import add_trackpoints
 
 
 logger = logging.getLogger(__name__)
@@ -48,19 +48,27 @@ class HeatmapController:
         )
         return self._xy
 
+    @functools.cache
+    def _points_by_latitude(self) -> pd.DataFrame:
+        # sorted once, so that each tile finds its latitude band by binary
+        # search and only has to filter that band by longitude
+        points = get_all_points(self._repository)
+        return points.sort_values("latitude", ignore_index=True)
+
     def render_tile(self, x: int, y: int, z: int) -> bytes:
         with self._mutex:
-            all_points = get_all_points(self._repository)
+            all_points = self._points_by_latitude()
 
         lat_max, lon_min = get_tile_upper_left_lat_lon(x, y, z)
         lat_min, lon_max = get_tile_upper_left_lat_lon(x + 1, y + 1, z)
 
         logger.info(f"Filtering relevant points for {x}/{y} at {z} …")
-        relevant_points = all_points.loc[
-            (lat_min <= all_points["latitude"])
-            & (all_points["latitude"] <= lat_max)
-            & (lon_min <= all_points["longitude"])
-            & (all_points["longitude"] <= lon_max)
+        latitudes = all_points["latitude"].to_numpy()
+        begin = np.searchsorted(latitudes, lat_min, side="left")
+        end = np.searchsorted(latitudes, lat_max, side="right")
+        band = all_points.iloc[begin:end]
+        relevant_points = band.loc[
+            (lon_min <= band["longitude"]) & (band["longitude"] <= lon_max)
         ]
 
         xy_data = latlon_to_xy(
@@ -73,17 +81,14 @@ class HeatmapController:
         xy_data = np.round((xy_data - [x_tile_min, y_tile_min]) * OSM_TILE_SIZE)
         sigma_pixel = 1
         data = np.zeros((OSM_TILE_SIZE, OSM_TILE_SIZE))
-        for j, i in xy_data.astype(int):
-            data[
-                i - sigma_pixel : i + sigma_pixel, j - sigma_pixel : j + sigma_pixel
-            ] += 1.0
+        add_trackpoints(data, xy_data, sigma_pixel)
 
         np.log(data, where=data > 0, out=data)
         data /= 6
         data_max = data.max()
         if data_max > 2:
             logger.warning(f"Maximum data in tile: {data_max}")
-        data[data > 1.0] = 1.0
+        np.minimum(data, 1.0, out=data)
 
         # colorize
         cmap = matplotlib.colormaps["hot"]
@@ -91,9 +96,7 @@ class HeatmapController:
         data_color = cmap(data)
         data_color[data_color == cmap(0.0)] = 0.0  # remove background color
 
-        map_tile = np.array(get_tile(z, x, y)) / 255
-        map_tile = np.sum(map_tile * [0.2126, 0.7152, 0.0722], axis=2)  # to grayscale
-        map_tile = 1.0 - map_tile  # invert colors
+        map_tile = 1.0 - get_grayscale_tile(z, x, y)  # invert colors
         map_tile = np.dstack((map_tile, map_tile, map_tile))  # to rgb
         for c in range(3):
             map_tile[:, :, c] = (1.0 - data_color[:, :, c]) * map_tile[